@@ -83,7 +83,12 @@ setuptools.setup(
         'console_scripts' : ['stringcheese=stringcheese.stringcheese:main']
     },
     install_requires = [
-        'tqdm'
+        'tqdm',
+        'numpy'
     ],
+    extras_require = {
+        'hyperscan' : ['hyperscan'],
+        'pybase64' : ['pybase64']
+    },
     zip_safe     = False
 )
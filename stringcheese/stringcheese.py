@@ -2,16 +2,55 @@
 
 import base64
 import binascii
-import gc
+import bisect
+import mmap
+import os
+import re
 import sys
 from argparse import ArgumentParser
 
+import numpy as np
 from stringcheese.ahocorasick import *
 from tqdm import tqdm
 
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None  # Optional, fall back to Aho-Corasick
+
+try:
+    from pybase64 import b64decode
+except ImportError:
+    from base64 import b64decode  # Optional, fall back to the stdlib
+
 MAX_FLAG_LENGTH = 2000
+CHUNK_SIZE = 1 << 20  # Haystacks are fed to the automaton in 1MB chunks
 CLOSING_CHAR = b'}'
 
+# Compiling a Hyperscan database takes ~0.1s, below this haystack size
+# building the Aho-Corasick automaton and scanning with it is faster
+HYPERSCAN_MIN_SIZE = 25000
+
+# Strides are searched in range(2, NB_STEPS)
+NB_STEPS = 33
+FAST_NB_STEPS = 8
+
+# First byte that cannot be part of a hex / binary encoded match
+NON_HEX_RE = re.compile(rb'[^0-9a-f]')
+NON_HEX_BYTES_RE = re.compile(rb'[^\x00-\x0f]')
+NON_BINARY_RE = re.compile(rb'[^01]')
+NON_BINARY_BYTES_RE = re.compile(rb'[^\x00\x01]')
+
+# First byte that cannot be part of a printed flag
+NON_PRINTABLE_RE = re.compile(rb'[^\x20-\x7e]')
+
+# Ignored inside base64 / base32 encoded matches
+WHITESPACE = b' \t\n\r\x0b\x0c'
+
+# Longest prefix made of base64 / base32 alphabet characters
+B64_PREFIX_RE = re.compile(rb'[A-Za-z0-9+/]*')
+B32_PREFIX_RE = re.compile(rb'[A-Z2-7]*')
+
 
 def setup_parser():
     parser = ArgumentParser(description='Find flags automatically in '
@@ -45,70 +84,53 @@ def identity_decoder(match):
 
 
 def b64_decoder(match):
-    try:
-        # If padding is present, b64decode ignores leftover data and works
-        return base64.b64decode(match)
-    except:
-        pass
+    # Ignore whitespace, e.g. line breaks in wrapped base64
+    match = match.translate(None, WHITESPACE)
 
-    # Try to find a decodeable base64 string by trimming progressively
-    for trim_len in range(len(match), -1, -1):
-        if trim_len % 4 == 1:
-            continue  # b64 is not compatible with this data length
-        trim_match = match[:trim_len]
-
-        # Add correct padding
-        while len(trim_match) % 4:
-            trim_match += b'='
-
-        try:
-            return base64.b64decode(trim_match)
-        except:
-            pass  # Decode failed. Ignore
-
-    return None  # All decodes failed
+    # Decode the longest valid base64 prefix. Once trimmed to a compatible
+    # length and padded, it always decodes: no need to retry shorter ones
+    prefix_len = B64_PREFIX_RE.match(match).end()
+    if prefix_len % 4 == 1:
+        prefix_len -= 1  # b64 is not compatible with this data length
+    trim_match = match[:prefix_len]
+    while len(trim_match) % 4:
+        trim_match += b'='
+    return b64decode(trim_match)
 
 
 def b32_decoder(match):
-    try:
-        # If padding is present, b32decode ignores leftover data and works
-        return base64.b32decode(match)
-    except:
-        pass
+    # Ignore whitespace, e.g. line breaks in wrapped base32
+    match = match.translate(None, WHITESPACE)
 
-    # Try to find a decodeable base32 string by trimming progressively
-    for trim_len in range(len(match), -1, -1):
-        if trim_len % 8 == 1:
-            continue  # b32 is not compatible with this data length
-        trim_match = match[:trim_len]
+    # Decode the longest valid base32 prefix. Once trimmed to a compatible
+    # length and padded, it always decodes: no need to retry shorter ones
+    prefix_len = B32_PREFIX_RE.match(match).end()
+    while prefix_len % 8 in (1, 3, 6):
+        prefix_len -= 1  # b32 is not compatible with this data length
+    trim_match = match[:prefix_len]
+    while len(trim_match) % 8:
+        trim_match += b'='
+    return base64.b32decode(trim_match)
 
-        # Add correct padding
-        while len(trim_match) % 8:
-            trim_match += b'='
 
-        try:
-            return base64.b32decode(trim_match)
-        except:
-            pass  # Decode failed. Ignore
+ROT13_TABLE = bytes.maketrans(
+    bytes(range(256)),
+    bytes((c - 65 + 13) % 26 + 65 if 65 <= c <= 90 else
+          (c - 97 + 13) % 26 + 97 if 97 <= c <= 122 else c
+          for c in range(256)))
 
-    return None  # All decodes failed
+ROT47_TABLE = bytes.maketrans(
+    bytes(range(256)),
+    bytes((c - 33 + 47) % 94 + 33 if 33 <= c <= 126 else c
+          for c in range(256)))
 
 
 def crypt_rot13(message):
-    d = {}
-    for c in (65, 97):
-        for i in range(26):
-            d[chr(i + c)] = chr((i + 13) % 26 + c)
-    return str.encode("".join([d.get(chr(c), chr(c)) for c in message]))
+    return bytes(message).translate(ROT13_TABLE)
 
 
 def crypt_rot47(message):
-    d = {}
-    for letter in range(47):
-        d[chr(letter + 33)] = chr((33 + letter) + 47)
-    for letter in range(47, 94):
-        d[chr(letter + 33)] = chr((33 + letter) - 47)
-    return str.encode("".join([d.get(chr(c), chr(c)) for c in message]))
+    return bytes(message).translate(ROT47_TABLE)
 
 
 def codec_decoder_generator(codec):
@@ -123,54 +145,88 @@ def codec_decoder_generator(codec):
     return codec_decoder
 
 
+def valid_prefix(match, invalid_re):
+    # Cut the match at the first byte matched by invalid_re
+    invalid = invalid_re.search(match)
+    if invalid:
+        return match[:invalid.start()]
+    return match
+
+
 def hex_decoder(match):
     # Ensure all bytes in the match are hex
-    for i in range(len(match)):
-        if match[i] not in b'0123456789abcdef':
-            match = match[:i]
-            break
+    match = valid_prefix(match, NON_HEX_RE)
     if len(match) % 2:
         match = match[:-1]
     return binascii.unhexlify(match)
 
 
 def hex_bytes_decoder(match):
-    for i in range(len(match)):
-        if match[i] > 0xf:
-            match = match[:i]
-            break
-    if len(match) % 2:
-        match = match[:-1]
-    return bytes(match[i] << 4 | match[i+1] for i in range(0, len(match), 2))
+    match = valid_prefix(match, NON_HEX_BYTES_RE)
+    nibbles = np.frombuffer(match, np.uint8)[:len(match) & ~1]
+    return (nibbles[::2] << 4 | nibbles[1::2]).tobytes()
 
 
 def bitstring_to_bytes(bitstring):
-    return int(bitstring, 2).to_bytes(len(bitstring) // 8, byteorder='big')
+    # Low bit of ASCII '0'/'1' is the bit value, packbits does the rest
+    bits = np.frombuffer(bitstring, np.uint8) & 1
+    return np.packbits(bits[:len(bits) - len(bits) % 8]).tobytes()
 
 
 def binary_decoder(match):
-    for i in range(len(match)):
-        if match[i] not in b'01':
-            match = match[:i]
-            break
-    while len(match) % 8:
-        match = match[:-1]
+    match = valid_prefix(match, NON_BINARY_RE)
     return bitstring_to_bytes(match)
 
 
 def binary_bytes_decoder(match):
-    for i in range(len(match)):
-        if match[i] > 1:
-            match = match[:i]
-            break
-    while len(match) % 8:
-        match = match[:-1]
-    bin_converted = bytes(ord('0')+x for x in match)
-    return bitstring_to_bytes(bin_converted)
-
-
-def build_automaton(pattern):
-    automaton = Automaton()
+    match = valid_prefix(match, NON_BINARY_BYTES_RE)
+    match = match[:len(match) - len(match) % 8]
+    return np.packbits(np.frombuffer(match, np.uint8)).tobytes()
+
+
+class HyperscanAutomaton:
+    # Same interface as the subset of ahocorasick.Automaton used here,
+    # backed by a Hyperscan block mode database. Hyperscan reports matches
+    # through a callback, so iter() buffers all the matches of a haystack
+    # (one chunk) in a list before returning them, unlike Automaton.iter()
+    def __init__(self):
+        self.words = {}
+        self.values = []
+        self.database = None
+
+    def add_word(self, word, value):
+        # Like Automaton.add_word, adding an existing word replaces its value
+        self.words[word] = value
+
+    def make_automaton(self):
+        self.values = list(self.words.values())
+        expressions = [b''.join(b'\\x%02x' % c for c in word)
+                       for word in self.words]
+        self.database = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+        self.database.compile(expressions=expressions,
+                              ids=list(range(len(expressions))),
+                              elements=len(expressions))
+
+    def iter(self, haystack):
+        matches = []
+
+        def on_match(word_id, start, end, flags, context):
+            matches.append((end - 1, self.values[word_id]))
+
+        self.database.scan(haystack, match_event_handler=on_match)
+        return iter(matches)
+
+    def get_stats(self):
+        return {'words_count': len(self.words),
+                'longest_word': max(map(len, self.words), default=0)}
+
+
+def build_automaton(pattern, haystack_size=None):
+    if hyperscan and (haystack_size is None
+                      or haystack_size >= HYPERSCAN_MIN_SIZE):
+        automaton = HyperscanAutomaton()
+    else:
+        automaton = Automaton()
 
     # identity match
     automaton.add_word(pattern, (pattern, 'ASCII', identity_decoder))
@@ -186,17 +242,20 @@ def build_automaton(pattern):
         b32pattern = b32pattern[:-1]
     automaton.add_word(b32pattern, (b32pattern, 'base32', b32_decoder))
 
-    # codec match
-    for codec in ('utf-16', 'utf-16-be', 'utf-16-le',
-                  'utf-32', 'utf-32-be', 'utf-32-le'):
+    # codec match. utf-16 and utf-32 are left out: their pattern is a BOM
+    # followed by the native -le/-be pattern, which finds the same matches
+    for codec in ('utf-16-be', 'utf-16-le', 'utf-32-be', 'utf-32-le'):
         codec_pattern = pattern.decode().encode(codec)
         codec_decoder = codec_decoder_generator(codec)
         automaton.add_word(codec_pattern, (codec_pattern, codec, codec_decoder))
 
-    # xor match
-    for xorval in range(1, 256):
-        xor_pattern = bytes(xorval ^ x for x in pattern)
-        xor_decoder = lambda s, xorval=xorval: bytes(xorval ^ x for x in s)
+    # xor match (all 255 keys at once, one row per key)
+    xorvals = np.arange(1, 256, dtype=np.uint8)
+    xor_patterns = xorvals[:, None] ^ np.frombuffer(pattern, np.uint8)[None, :]
+    for xorval, xor_row in zip(range(1, 256), xor_patterns):
+        xor_pattern = xor_row.tobytes()
+        xor_decoder = lambda s, xorval=xorval: \
+            (np.frombuffer(s, np.uint8) ^ xorval).tobytes()
         automaton.add_word(xor_pattern,
                            (xor_pattern, f'XOR_{xorval}', xor_decoder))
 
@@ -205,12 +264,15 @@ def build_automaton(pattern):
     automaton.add_word(hex_pattern, (hex_pattern, 'hex', hex_decoder))
 
     # raw hex match (bytes are \x00 through \x0f)
-    raw_hex_pattern = bytes(int(x) for x in hex_pattern)
+    pattern_array = np.frombuffer(pattern, np.uint8)
+    raw_hex_pattern = np.stack((pattern_array >> 4,
+                                pattern_array & 0xf), axis=1).tobytes()
     automaton.add_word(raw_hex_pattern,
                        (raw_hex_pattern, 'raw_hex', hex_bytes_decoder))
 
     # binary match
-    bin_pattern = ''.join(f'{pb:08b}' for pb in pattern).encode()
+    pattern_bits = np.unpackbits(pattern_array)
+    bin_pattern = (pattern_bits + ord('0')).tobytes()
     automaton.add_word(bin_pattern, (bin_pattern, 'binary', binary_decoder))
 
     # rot13 match
@@ -223,8 +285,8 @@ def build_automaton(pattern):
     automaton.add_word(raw_rot47_pattern,
                        (raw_rot47_pattern, 'raw_rot47', crypt_rot47))
 
-    # raw binary match
-    raw_bin_pattern = bytes(int(x) for x in bin_pattern)
+    # raw binary match (bytes are \x00 and \x01)
+    raw_bin_pattern = pattern_bits.tobytes()
     automaton.add_word(raw_bin_pattern,
                        (raw_bin_pattern, 'raw_binary', binary_bytes_decoder))
 
@@ -236,37 +298,73 @@ def build_automaton(pattern):
 
 def postprocess_match(raw_match):
     # Return a printable prefix of the match, ending at } if found
-    for i, match_byte in enumerate(raw_match):
-        if match_byte < 32 or match_byte > 126:
-            raw_match = raw_match[:i]
-            break
+    non_printable = NON_PRINTABLE_RE.search(raw_match)
+    end = non_printable.start() if non_printable else len(raw_match)
 
-    if CLOSING_CHAR in raw_match:
-        raw_match = raw_match.split(CLOSING_CHAR)[0] + CLOSING_CHAR
+    closing = raw_match.find(CLOSING_CHAR, 0, end)
+    if closing >= 0:
+        end = closing + len(CLOSING_CHAR)
 
-    return raw_match.decode()
+    return raw_match[:end].decode()
 
 
 def generate_haystacks(base_haystack, fast):
-    yield base_haystack, 'stream'
-    nb_steps = 33 if not fast else 8
+    # base_haystack is a uint8 ndarray, every haystack is a zero-copy view.
+    # Haystacks are yielded in groups which are scanned in a single pass.
+    yield [(base_haystack, 'stream')]
+    nb_steps = NB_STEPS if not fast else FAST_NB_STEPS
     for step in range(2, nb_steps):
-        for startpos in range(step):
-            yield base_haystack[startpos::step], f'stream[{startpos}::{step}]'
+        yield [(base_haystack[startpos::step], f'stream[{startpos}::{step}]')
+               for startpos in range(step)]
 
-    yield base_haystack[::-1], 'reversed stream'
+    yield [(base_haystack[::-1], 'reversed stream')]
 
     # TODO : add local xor for simple crackme challs? but may be slow
 
 
-def extract_matches(automaton, filename, fast, verbose):
+def group_chunk(views, haystack_starts, begin, end):
+    # Bytes [begin, end) of the concatenation of views, where
+    # haystack_starts holds the offset of each view in the concatenation
+    parts = []
+    view_index = bisect.bisect_right(haystack_starts, begin) - 1
+    while begin < end:
+        view_start = haystack_starts[view_index]
+        part_end = min(end, haystack_starts[view_index + 1])
+        parts.append(views[view_index][begin - view_start:
+                                       part_end - view_start])
+        begin = part_end
+        view_index += 1
+    if len(parts) == 1:
+        return parts[0].tobytes()  # No need for a concatenated copy
+    return np.concatenate(parts).tobytes() if parts else b''
+
+
+def report_match(raw_match, haystack_name, enc_desc, decoder, verbose):
+    tqdm.write(f'MATCH FOUND! '
+               f'In {haystack_name}, using encoding {enc_desc}:')
+    if verbose:
+        tqdm.write(binascii.hexlify(raw_match).decode())
+    decoded_flag = decoder(raw_match)
+    # tqdm.write(binascii.hexlify(decoded_flag).decode())
+    processed_match = postprocess_match(decoded_flag)
+    tqdm.write(processed_match)
+
+
+def extract_matches(automaton, filename, fast, verbose, plain_pattern=None):
     if filename == '-':
         print('No filename provided, reading from stdin.')
         file_contents = sys.stdin.buffer.read()
     else:
         try:
             with open(filename, 'rb') as haystack_file:
-                file_contents = haystack_file.read()
+                # Map the file instead of reading it, pages are loaded
+                # on demand by the OS. Empty files and non-regular files
+                # (pipes, FIFOs) cannot be mapped.
+                try:
+                    file_contents = mmap.mmap(haystack_file.fileno(), 0,
+                                              access=mmap.ACCESS_READ)
+                except (ValueError, OSError):
+                    file_contents = haystack_file.read()
         except:
             print('Error opening file.')
             sys.exit(0)
@@ -275,41 +373,73 @@ def extract_matches(automaton, filename, fast, verbose):
                     "some flags. Do you wish to continue? (y/N) : ")
         if val != 'y':
             sys.exit(0)
-    if len(file_contents) > 50000:
-        val = input("This is a large file and may take a long time to be treated, do you wish to continue? (y/N) : ")
-        if val != 'y':
-            sys.exit(0)
 
     # TODO : decode file formats (zip, png pixels, etc)
 
-    match_found = False
+    if fast and plain_pattern:
+        # Fast mode stops at the first match, and the plain pattern is the
+        # most common one: look for it with a single find() before
+        # running the automaton over all the haystacks
+        start_index = file_contents.find(plain_pattern)
+        if start_index >= 0:
+            raw_match = file_contents[start_index:
+                                      start_index+MAX_FLAG_LENGTH]
+            report_match(raw_match, 'stream', 'ASCII', identity_decoder,
+                         verbose)
+            sys.exit(0)
 
-    # Compute the number of haystacks by counting them on a fake base
-    n_haystacks = sum(1 for _ in generate_haystacks(b'fake haystack', fast))
+    match_found = False
 
-    progress = tqdm(total=n_haystacks)
-    for haystack, haystack_name in generate_haystacks(file_contents, fast):
-        match_iter = list(automaton.iter(haystack))
-        if match_iter:
-            for end_index, (pattern, enc_desc, decoder) in match_iter:
-                match_found = True
+    # Stream and reversed stream, plus one haystack per startpos of each step
+    nb_steps = NB_STEPS if not fast else FAST_NB_STEPS
+    n_haystacks = 2 + (nb_steps - 2) * (nb_steps + 1) // 2
+
+    # Chunks overlap so that needles across chunk boundaries are found
+    chunk_overlap = max(automaton.get_stats()['longest_word'] - 1, 0)
+
+    file_array = np.frombuffer(file_contents, np.uint8)
+    progress = tqdm(total=n_haystacks, mininterval=0.5)
+    for haystack_group in generate_haystacks(file_array, fast):
+        # Scan the concatenation of all the haystacks of a group at once,
+        # one chunk at a time: the automaton needs bytes, and this keeps
+        # the copies small
+        views = [view for view, _ in haystack_group]
+        haystack_starts = [0]
+        for view in views:
+            haystack_starts.append(haystack_starts[-1] + len(view))
+
+        chunk_start = 0
+        while True:
+            chunk_end = min(chunk_start + CHUNK_SIZE, haystack_starts[-1])
+            scan_start = max(chunk_start - chunk_overlap, 0)
+            chunk = group_chunk(views, haystack_starts, scan_start, chunk_end)
+
+            match_iter = automaton.iter(chunk)
+            for chunk_end_index, (pattern, enc_desc, decoder) in match_iter:
+                end_index = scan_start + chunk_end_index
+                if end_index < chunk_start:
+                    continue  # Already found in the previous chunk
                 start_index = end_index - len(pattern) + 1
-                raw_match = haystack[start_index:start_index+MAX_FLAG_LENGTH]
-                tqdm.write(f'MATCH FOUND! '
-                           f'In {haystack_name}, using encoding {enc_desc}:')
-                if verbose:
-                    tqdm.write(binascii.hexlify(raw_match).decode())
-                decoded_flag = decoder(raw_match)
-                # tqdm.write(binascii.hexlify(decoded_flag).decode())
-                processed_match = postprocess_match(decoded_flag)
-                tqdm.write(processed_match)
+                haystack_index = bisect.bisect_right(haystack_starts,
+                                                     end_index) - 1
+                haystack_start = haystack_starts[haystack_index]
+                if start_index < haystack_start:
+                    continue  # Match spans two haystacks of the group
+                haystack, haystack_name = haystack_group[haystack_index]
+                match_found = True
+                match_offset = start_index - haystack_start
+                raw_match = haystack[match_offset:
+                                     match_offset+MAX_FLAG_LENGTH].tobytes()
+                report_match(raw_match, haystack_name, enc_desc, decoder,
+                             verbose)
                 if fast:
                     sys.exit(0)
 
-        # Keep memory consumption low
-        del haystack
-        gc.collect()
-        progress.update(1)
+            if chunk_end == haystack_starts[-1]:
+                break
+            chunk_start = chunk_end
+
+        progress.update(len(haystack_group))
     progress.close()
 
     if not match_found:
@@ -323,8 +453,12 @@ def main():
     filename = args.file
     fast_mode = args.fast
     verbose_mode = args.verbose
-    automaton = build_automaton(pattern)
-    extract_matches(automaton, filename, fast_mode, verbose_mode)
+    try:
+        haystack_size = os.path.getsize(filename) if filename != '-' else None
+    except OSError:
+        haystack_size = None  # extract_matches reports the error
+    automaton = build_automaton(pattern, haystack_size)
+    extract_matches(automaton, filename, fast_mode, verbose_mode, pattern)
 
 
 if __name__ == '__main__':